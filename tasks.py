@@ -1,10 +1,20 @@
+import hashlib
+import os
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 from typing import List, Optional, Union, Literal
 
-from invoke import task
+from invoke import call, task
 
 
 poetry_pypi_testing = "testpypi"
 
+# Must match the one used by the test suite, see tests/conftest.py
+test_cassettes_folder = "tests/cassettes"
+test_cassettes_env_var = "VCRPY_ENCRYPT_TEST_CASSETTES"
+
 # Supported python version lists - these must also be valid executable in your path
 legacy_supported_python_versions = ["python3.8", "python3.9"]
 supported_python_versions = ["python3.10", "python3.11", "python3.12"]
@@ -12,26 +22,83 @@ supported_python_versions = ["python3.10", "python3.11", "python3.12"]
 default_python_bin = legacy_supported_python_versions[0]
 
 
+# Name of the file, inside a venv, holding the hash of the project files the venv was last synced with
+install_stamp_file = ".poetry_install_hash"
+# Name of the file, in the project root, holding the path of the venv last prepared by the install task
+venv_path_file = ".poetry_venv_path"
+
+
+def _install_hash() -> str:
+    """Hash the files a 'poetry install' depends on: a change to any of them means the venv must be synced again."""
+    digest = hashlib.sha256()
+    for file_name in ("poetry.lock", "pyproject.toml"):
+        digest.update(Path(file_name).read_bytes())
+    return digest.hexdigest()
+
+
+def _venv_path(c) -> Optional[Path]:
+    """Return the path of the currently active poetry venv, if there is one."""
+    venv_path = c.run("poetry env info -p", hide=True, warn=True).stdout.strip()
+    if venv_path:
+        return Path(venv_path)
+    return None
+
+
+def _venv_python_works(venv_path: Path) -> bool:
+    """Check that the venv python is still there: its symlinks may point to a python that's no longer installed."""
+    # exists() follows symlinks, so a dangling one counts as missing
+    return (venv_path / "bin" / "python").exists()
+
+
+def _record_venv_path(venv_path: Optional[Path]) -> None:
+    """Remember the venv path, so that other tasks can use it without asking poetry again."""
+    if venv_path is not None:
+        Path(venv_path_file).write_text(str(venv_path))
+
+
 # If the most currently activated python version is desired, use 'inv install -p latest'
+# A venv already synced with the current poetry.lock and pyproject.toml is not reinstalled, unless '--force-install'
+# is given
 @task
-def install(c, python=default_python_bin):
+def install(c, python=default_python_bin, force_install=False) -> Optional[Path]:
     if python == "latest":
         # don't do anything here: poetry will use the default python version
         pass
     else:
         c.run("poetry env use {}".format(python))
-    c.run("poetry install")
+    install_hash = _install_hash()
+    # Only ask poetry once for the venv path: it's a whole poetry startup every time
+    venv_path = _venv_path(c)
+    if venv_path is not None and not _venv_python_works(venv_path):
+        # e.g. a cached venv whose base python has been replaced by a new patch version: start from scratch
+        print("Venv python is broken, recreating the venv.")
+        shutil.rmtree(venv_path, ignore_errors=True)
+        venv_path = None
+    stamp = venv_path / install_stamp_file if venv_path else None
+    if not force_install and stamp is not None and stamp.is_file() and stamp.read_text() == install_hash:
+        print("Dependencies already up to date, skipping poetry install.")
+        _record_venv_path(venv_path)
+        return venv_path
+    # The project changed since the last install: also drop packages the lock no longer lists
+    c.run("poetry install --sync --no-interaction")
+    if venv_path is None:
+        # A brand new venv has just been created by poetry install
+        venv_path = _venv_path(c)
+    if venv_path is not None:
+        (venv_path / install_stamp_file).write_text(install_hash)
+    _record_venv_path(venv_path)
+    return venv_path
 
 
 @task
 def rm_venv(c):
-    c.run("rm -rf .venv")
+    shutil.rmtree(".venv", ignore_errors=True)
 
 
 # Use this to change quickly python version
 @task(rm_venv)
-def reinstall(c, python=default_python_bin):
-    install(c, python)
+def reinstall(c, python=default_python_bin, force_install=False) -> Optional[Path]:
+    return install(c, python, force_install)
 
 
 @task
@@ -54,88 +121,164 @@ def publish(c):
     c.run("poetry publish")
 
 
+def _pytest() -> str:
+    """Return the command used to launch pytest in the project venv.
+
+    With VCRPY_FAST_TESTS=1 pytest is launched straight from the venv (the activated one, or the one last prepared by
+    the install task), skipping the poetry startup that 'poetry run' pays on every invocation."""
+    if os.environ.get("VCRPY_FAST_TESTS") == "1":
+        venv_path = os.environ.get("VIRTUAL_ENV")
+        if venv_path is None and Path(venv_path_file).is_file():
+            venv_path = Path(venv_path_file).read_text().strip()
+        if venv_path:
+            pytest_bin = Path(venv_path) / "bin" / "pytest"
+            if pytest_bin.is_file():
+                return shlex.quote(str(pytest_bin))
+    return "poetry run pytest"
+
+
+def _parallel_flags(parallel: bool) -> str:
+    """Return the pytest-xdist flags needed to spread the tests over all available cores, if asked for with
+    '--parallel' or by setting VCRPY_ENCRYPT_PARALLEL=1. Every test uses its own cassettes, so they can be freely
+    distributed.
+
+    Off by default: the suite is small enough that starting the workers costs more than it saves."""
+    if parallel or os.environ.get("VCRPY_ENCRYPT_PARALLEL") == "1":
+        return " -n auto --dist load"
+    return ""
+
+
+def _sugar_flags(pretty: bool) -> str:
+    """Return the flags needed to disable pytest-sugar, unless its prettier output has been explicitly asked for."""
+    if pretty:
+        return ""
+    return " -p no:sugar"
+
+
+# Use '--lf' to only rerun the tests that failed last time, or '--ff' to run them first: both are passed to pytest
 @task()
-def test(c, s=False, m=None):
+def test(c, s=False, m=None, parallel=False, lf=False, ff=False, pretty=False):
     marks = ""
     if m is not None:
         marks = f" -m {m}"
     capture = ""
     if s:
         capture = " -s"
-    c.run(f"poetry run pytest{capture}{marks}", pty=True)
+    failed_first = ""
+    if lf:
+        failed_first += " --lf"
+    if ff:
+        failed_first += " --ff"
+    c.run(f"{_pytest()}{_parallel_flags(parallel)}{_sugar_flags(pretty)}{capture}{marks}{failed_first}", pty=True)
 
 
 @task()
-def test_spec(c, m=None):
+def test_spec(c, m=None, parallel=False):
     marks = ""
     if m is not None:
         marks = f" -m {m}"
-    c.run(f"poetry run pytest -p no:sugar --spec{marks}", pty=True)
+    c.run(f"{_pytest()}{_parallel_flags(parallel)}{_sugar_flags(False)} --spec{marks}", pty=True)
 
 
+# Versions are tested concurrently: use '--serial' to test them one at a time while streaming the tests output
 @task()
-def test_all_python_versions(c, coverage=False):
-    test_all_legacy_python_versions(c, coverage)
-    test_all_new_python_versions(c, coverage)
+def test_all_python_versions(c, coverage=False, parallel=False, serial=False):
+    test_all_legacy_python_versions(c, coverage, parallel, serial)
+    test_all_new_python_versions(c, coverage, parallel, serial)
 
 
 @task()
-def test_all_new_python_versions(c, coverage=False):
+def test_all_new_python_versions(c, coverage=False, parallel=False, serial=False):
     # Run the tests on an inverted supported_python_versions list, so that the last one is the default one so
     # no reset is needed
     python_versions = supported_python_versions.copy()
     python_versions.reverse()
-    test_python_versions(c, python_versions, coverage)
+    test_python_versions(c, python_versions, coverage, parallel, serial)
 
 
 @task()
-def test_all_legacy_python_versions(c, coverage=False):
+def test_all_legacy_python_versions(c, coverage=False, parallel=False, serial=False):
     # Run the tests on an inverted supported_python_versions list, so that the last one is the default one so
     # no reset is needed
     python_versions = legacy_supported_python_versions.copy()
     python_versions.reverse()
-    test_python_versions(c, python_versions, coverage)
+    test_python_versions(c, python_versions, coverage, parallel, serial)
+
 
+def _venv_python(venv_path: Path) -> str:
+    """Return the venv python executable, quoted so that it can be safely used in a shell command."""
+    return shlex.quote(str(Path(venv_path) / "bin" / "python"))
 
-def test_python_versions(c, python_versions: List[str], coverage=False):
-    cov = ""
+
+def test_python_versions(c, python_versions: List[str], coverage=False, parallel=False, serial=False):
+    flags = f" --color=yes{_sugar_flags(False)}"
     if coverage:
-        cov = " --cov=vcrpy_encrypt"
-    python_version_checked = ""
+        flags += " --cov=vcrpy_encrypt"
+    flags += _parallel_flags(parallel)
+    print("\n>>> Make sure cassettes folder is empty\n")
+    clear_cassettes(c)
+    # Venvs are prepared one at a time, since 'poetry env use' changes the active venv of the whole project
+    venvs = {}
     for version in python_versions:
-        print("\n>>> Make sure cassettes folder is empty\n")
-        clear_cassettes(c)
         print(f"\n>>> Installing python venv with version: {version}\n")
-        reinstall(c, python=version)
-        print(f"\n>>> Running tests with version: {version}\n")
-        result = c.run(f"poetry run pytest{cov}", pty=True, warn=True)
-        if result.ok:
-            python_version_checked += f" {version}"
-        else:
-            print(f"\n>>> Could not test correctly under {version} - stopping here!")
-            exit(1)
-    print(f"\n>>> All test passed! Python version tested:{python_version_checked}")
+        venvs[version] = reinstall(c, python=version)
+
+    def _run_tests(version: str, **kwargs):
+        # Each version gets its own cassettes folder and coverage data file, so that concurrent runs don't clash
+        env = {test_cassettes_env_var: f"{test_cassettes_folder}/{version}", "COVERAGE_FILE": f".coverage.{version}"}
+        return c.run(f"{_venv_python(venvs[version])} -m pytest{flags}", env=env, warn=True, **kwargs)
+
+    failed_versions = []
+    if serial:
+        for version in python_versions:
+            print(f"\n>>> Running tests with version: {version}\n")
+            if not _run_tests(version, pty=True).ok:
+                failed_versions.append(version)
+    else:
+        print(f"\n>>> Running tests with versions: {' '.join(python_versions)}\n")
+        with ThreadPoolExecutor(max_workers=min(len(python_versions), os.cpu_count() or 1)) as executor:
+            futures = {executor.submit(_run_tests, version, hide=True): version for version in python_versions}
+            for future in as_completed(futures):
+                version = futures[future]
+                result = future.result()
+                print(f"\n>>> Tests output with version: {version}\n")
+                print(result.stdout, result.stderr, sep="")
+                if not result.ok:
+                    failed_versions.append(version)
+    coverage_files = [f".coverage.{version}" for version in python_versions]
+    if failed_versions:
+        # The partial coverage data of a failed matrix is useless: don't leave it lying around
+        for coverage_file in coverage_files:
+            Path(coverage_file).unlink(missing_ok=True)
+        print(f"\n>>> Could not test correctly under: {' '.join(failed_versions)}")
+        exit(1)
+    if coverage:
+        # combine also removes the per version data files
+        c.run(f"{_venv_python(venvs[python_versions[-1]])} -m coverage combine {' '.join(coverage_files)}", hide=True)
+    print(f"\n>>> All test passed! Python version tested: {' '.join(python_versions)}")
     print(f"\n>>> Current venv python version: {python_versions[-1]}")
 
 
 @task()
 def clear_cassettes(c):
-    c.run("rm -rf tests/cassettes")
+    shutil.rmtree(test_cassettes_folder, ignore_errors=True)
     print("Cleared!")
 
 
+# Only the terminal report is produced by default: use '--html' (or the html-cov task) for the browsable one
 @task()
-def test_cov(c, m=None):
-    c.run("mkdir -p coverage")
+def test_cov(c, m=None, parallel=False, pretty=False, html=False):
+    reports = " --cov-report term-missing"
+    if html:
+        Path("coverage").mkdir(parents=True, exist_ok=True)
+        reports = " --cov-report annotate:coverage/cov_annotate --cov-report html:coverage/cov_html"
     marks = ""
     if m is not None:
         marks = f" -m {m}"
-    c.run(
-        f"poetry run pytest --cov=vcrpy_encrypt --cov-report annotate:coverage/cov_annotate --cov-report "
-        f"html:coverage/cov_html{marks}", pty=True)
+    c.run(f"{_pytest()}{_parallel_flags(parallel)}{_sugar_flags(pretty)} --cov=vcrpy_encrypt{reports}{marks}", pty=True)
 
 
-@task(test_cov)
+@task(pre=[call(test_cov, html=True)])
 def html_cov(c):
     c.run("xdg-open coverage/cov_html/index.html")
 
@@ -172,6 +315,7 @@ def act(c, shell: Optional[AvailableContainer] = None, clean: Optional[Available
         c.run(f"docker exec --env-file {act_secrets_file} -it {act_ctx} bash", pty=True)
     elif clean:
         act_ctx = _get_container_id(clean)
-        c.run(f"docker rm -f {act_ctx}", pty=True)
+        c.run(f"docker rm -f {act_ctx}", hide=True)
+        print("Removed!")
     else:
         c.run("act -W .github/workflows/ci.yml", pty=True)
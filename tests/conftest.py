@@ -6,19 +6,33 @@ import shutil
 
 from time import sleep
 
-test_cassettes_folder = "tests/cassettes"
+# Can be overridden to let multiple test runs (e.g. one per python version) proceed side by side
+test_cassettes_folder = os.environ.get("VCRPY_ENCRYPT_TEST_CASSETTES", "tests/cassettes")
+
+
+def _clear_cassettes_folder():
+    if os.path.isdir(test_cassettes_folder):
+        shutil.rmtree(test_cassettes_folder)
 
 
 #
 # ensure the cassettes folder used for testing is cleared
 #
 @pytest.fixture(scope="session")
-def clear_cassettes():
-    if os.path.isdir(test_cassettes_folder):
-        shutil.rmtree(test_cassettes_folder)
+def clear_cassettes(request):
+    # With pytest-xdist every worker gets its own session: only the main process can safely clear the folder,
+    # otherwise a late worker could delete the cassettes another one is still using.
+    if not hasattr(request.config, "workerinput"):
+        _clear_cassettes_folder()
     yield
 
 
+def pytest_configure(config):
+    # The xdist controller never runs fixtures, so it clears the folder here, before spawning its workers
+    if getattr(config.option, "numprocesses", None) and not hasattr(config, "workerinput"):
+        _clear_cassettes_folder()
+
+
 def _wait_for(condition: Callable[[], bool], wait_timeout: int = 3) -> bool:
     """
     A helper function that waits for a condition to be met or a timeout to be reached.
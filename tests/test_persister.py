@@ -3,13 +3,21 @@ import pytest
 import requests
 import vcr
 
+from vcr.request import Request
+from vcr.serialize import serialize
 from vcr.serializers import yamlserializer
 from vcr.persisters.filesystem import CassetteNotFoundError, CassetteDecodeError
 
 from tests.conftest import test_cassettes_folder
 
 from vcrpy_encrypt import BaseEncryptedPersister, generate_key
-from vcrpy_encrypt.persister import NotConfiguredException
+from vcrpy_encrypt.persister import NotConfiguredException, _write_atomically
+
+
+def _cassette_dict(uri: str = "https://google.com/?q=super-secret", body: bytes = b"secret") -> dict:
+    """Build a minimal cassette, with a single request and its response, to be saved without any network access."""
+    return {"requests": [Request("GET", uri, None, {})],
+            "responses": [{"status": {"code": 200, "message": "OK"}, "headers": {}, "body": {"string": body}}]}
 
 
 class TestTheEncryptedPersister:
@@ -162,12 +170,147 @@ class TestTheEncryptedPersister:
         persister = BaseEncryptedPersister
         cassette_path = f"{test_cassettes_folder}/broken"
         if not os.path.isdir(test_cassettes_folder):
-            os.mkdir(test_cassettes_folder)
+            os.makedirs(test_cassettes_folder)
         with open(cassette_path + persister.encoded_suffix, "w+") as f:
             f.write("this is not a valid cassette")
         with pytest.raises(CassetteDecodeError):
             persister.load_cassette(cassette_path, yamlserializer)
 
+    def test_should_reuse_its_cipher_until_the_encryption_key_changes(self):
+        """It should reuse its cipher until the encryption key changes"""
+
+        class MyPersister(BaseEncryptedPersister):
+            encryption_key: bytes = "secretpassword12".encode("UTF-8")
+
+        # the cipher is already built when the class is defined
+        assert "_cipher" in MyPersister.__dict__
+        cipher = MyPersister._get_cipher()
+        assert MyPersister._get_cipher() is cipher
+        MyPersister.encryption_key = "secretpassword34".encode("UTF-8")
+        assert MyPersister._get_cipher() is not cipher
+
+    def test_can_compress_cassettes_before_encrypting_them(self):
+        """It can compress cassettes before encrypting them"""
+
+        class MyPersister(BaseEncryptedPersister):
+            encryption_key: bytes = "secretpassword12".encode("UTF-8")
+            should_output_clear_text_as_well = True
+            should_compress = True
+
+        cassette_path = f"{test_cassettes_folder}/compressed"
+        body = b"a very repetitive response body " * 100
+        MyPersister.save_cassette(cassette_path, _cassette_dict(body=body), yamlserializer)
+
+        # The encrypted cassette is way smaller than the clear text one
+        encoded_size = os.path.getsize(f"{cassette_path}{MyPersister.encoded_suffix}")
+        assert encoded_size < os.path.getsize(f"{cassette_path}{MyPersister.clear_text_suffix}") / 2
+
+        class MyUncompressedPersister(BaseEncryptedPersister):
+            encryption_key: bytes = "secretpassword12".encode("UTF-8")
+
+        # Both compressing and non compressing persisters can read it back
+        for persister in (MyPersister, MyUncompressedPersister):
+            requests, responses = persister.load_cassette(cassette_path, yamlserializer)
+            assert requests[0].uri == "https://google.com/?q=super-secret"
+            assert responses[0]["body"]["string"] == body
+
+    def test_should_tell_apart_format_headers_from_nonces(self):
+        """It should tell apart format headers from nonces"""
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+        class MyPersister(BaseEncryptedPersister):
+            encryption_key: bytes = "secretpassword12".encode("UTF-8")
+
+        os.makedirs(test_cassettes_folder, exist_ok=True)
+        cipher = AESGCM(MyPersister.encryption_key)
+        data = serialize(_cassette_dict(), yamlserializer).encode("UTF-8")
+
+        # A header with unknown flags comes from a newer version: refuse it instead of misreading it
+        cassette_path = f"{test_cassettes_folder}/unknown-format"
+        header, nonce = b"VCRE" + bytes([0x02]), os.urandom(12)
+        with open(f"{cassette_path}{MyPersister.encoded_suffix}", "wb") as f:
+            f.write(header + nonce + cipher.encrypt(nonce, data, header))
+        with pytest.raises(CassetteDecodeError, match="unsupported cassette format"):
+            MyPersister.load_cassette(cassette_path, yamlserializer)
+
+        # A headerless cassette whose random nonce happens to start like the header is still read correctly
+        cassette_path = f"{test_cassettes_folder}/magic-nonce"
+        nonce = b"VCRE" + os.urandom(8)
+        with open(f"{cassette_path}{MyPersister.encoded_suffix}", "wb") as f:
+            f.write(nonce + cipher.encrypt(nonce, data, None))
+        _, responses = MyPersister.load_cassette(cassette_path, yamlserializer)
+        assert responses[0]["body"]["string"] == b"secret"
+
+    def test_can_use_a_different_encryption_algorithm(self):
+        """It can use a different encryption algorithm"""
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+        class MyPersister(BaseEncryptedPersister):
+            encryption_key: bytes = generate_key(256)
+            cipher_class = ChaCha20Poly1305
+
+        class MyAesPersister(BaseEncryptedPersister):
+            encryption_key: bytes = MyPersister.encryption_key
+
+        cassette_path = f"{test_cassettes_folder}/chacha20"
+        MyPersister.save_cassette(cassette_path, _cassette_dict(), yamlserializer)
+
+        _, responses = MyPersister.load_cassette(cassette_path, yamlserializer)
+        assert responses[0]["body"]["string"] == b"secret"
+        # The same key is not enough to decode it with a different algorithm
+        with pytest.raises(CassetteDecodeError):
+            MyAesPersister.load_cassette(cassette_path, yamlserializer)
+
+    def test_can_save_multiple_cassettes_at_once(self):
+        """It can save multiple cassettes at once"""
+
+        class MyPersister(BaseEncryptedPersister):
+            encryption_key: bytes = "secretpassword12".encode("UTF-8")
+
+        cassettes = []
+        for name in ("first", "second"):
+            cassette_dict = _cassette_dict(f"https://google.com/?q={name}", name.encode("UTF-8"))
+            cassettes.append((f"{test_cassettes_folder}/many/{name}", cassette_dict, yamlserializer))
+
+        MyPersister.save_many(cassettes)
+
+        for cassette_path, cassette_dict, serializer in cassettes:
+            requests, _ = MyPersister.load_cassette(cassette_path, serializer)
+            assert requests[0].uri == cassette_dict["requests"][0].uri
+
+
+class TestTheAtomicWrite:
+    """Test: The atomic write..."""
+
+    def test_should_leave_no_temporary_file_behind(self):
+        """It should leave no temporary file behind"""
+        folder = f"{test_cassettes_folder}/atomic"
+        os.makedirs(folder, exist_ok=True)
+
+        _write_atomically(f"{folder}/cassette", b"content")
+
+        with open(f"{folder}/cassette", "rb") as f:
+            assert f.read() == b"content"
+        assert [name for name in os.listdir(folder) if name.endswith(".tmp")] == []
+
+    def test_should_clean_up_the_temporary_file_when_the_write_fails(self, monkeypatch):
+        """It should clean up the temporary file when the write fails"""
+        folder = f"{test_cassettes_folder}/atomic-failure"
+        os.makedirs(folder, exist_ok=True)
+        _write_atomically(f"{folder}/cassette", b"old content")
+
+        def _failing_replace(src, dst):
+            raise OSError("disk on fire")
+
+        monkeypatch.setattr(os, "replace", _failing_replace)
+        with pytest.raises(OSError):
+            _write_atomically(f"{folder}/cassette", b"new content")
+
+        # The previous version is untouched and the temporary file is gone
+        with open(f"{folder}/cassette", "rb") as f:
+            assert f.read() == b"old content"
+        assert [name for name in os.listdir(folder) if name.endswith(".tmp")] == []
+
 
 class TestTheGenerateKeyFunction:
     """Test: The generate key function..."""
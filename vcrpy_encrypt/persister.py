@@ -2,12 +2,24 @@ from abc import ABC
 import os
 import secrets
 import string
-from typing import Union
+import threading
+import zlib
+from typing import Any, Iterable, Optional, Tuple, Type, Union
 
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag, UnsupportedAlgorithm
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, AESGCMSIV, ChaCha20Poly1305
 from vcr.serialize import deserialize, serialize
 from vcr.persisters.filesystem import CassetteNotFoundError, CassetteDecodeError
 
+# All of these take a 12 bytes nonce and bundle their tag together with the ciphertext
+AeadCipher = Union[AESGCM, AESGCMSIV, ChaCha20Poly1305]
+
+# Cassettes saved with some format option enabled start with this header, made of a magic string and a flags byte:
+# cassettes without it start straight with their nonce, as they always did.
+_header_magic = b"VCRE"
+_header_length = len(_header_magic) + 1
+_compressed_flag = 0x01
+
 
 def generate_key(bit_length: int = 128) -> bytes:
     """Utility method to generate a valid aes key as a UTF-8 encoded string. Valid bit_length values are 128, 192
@@ -19,12 +31,27 @@ def generate_key(bit_length: int = 128) -> bytes:
     return "".join(secrets.choice(available_chars) for _ in range(length)).encode("UTF-8")
 
 
+def _write_atomically(path: str, data: bytes) -> None:
+    """Write data to a temporary file, then move it in place: readers (e.g. other test workers) will only ever see the
+    previous version of the file or the complete new one, never a partially written one."""
+    # unique to the writing thread, so that concurrent saves of the same cassette never share a temporary file
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 class NotConfiguredException(RuntimeError):
     """Exception raised when a module configuration key is missing"""
 
 
 class BaseEncryptedPersister(ABC):
-    """VCR custom persister that will encrypt and decrypt cassettes with AES-GCM on disk.
+    """VCR custom persister that will encrypt and decrypt cassettes on disk, with AES-GCM by default.
 
     This class should be extended with a custom encryption_key field."""
 
@@ -32,6 +59,22 @@ class BaseEncryptedPersister(ABC):
     should_output_clear_text_as_well: bool = False
     clear_text_suffix: str = ""
     encoded_suffix: str = ".enc"
+    should_compress: bool = False
+    cipher_class: Type[AeadCipher] = AESGCM
+
+    # last built cipher, together with the key and the algorithm it was built with
+    _cipher: Optional[Tuple[bytes, Type[AeadCipher], AeadCipher]] = None
+
+    def __init_subclass__(cls, **kwargs):
+        """Build the cipher as soon as a subclass provides a valid key, so that it's ready before the first cassette.
+        A missing or invalid key (or an unsupported algorithm) is left to be reported when the persister is actually
+        used."""
+        super().__init_subclass__(**kwargs)
+        if cls.encryption_key is not None:
+            try:
+                cls._cipher = (cls.encryption_key, cls.cipher_class, cls.cipher_class(cls.encryption_key))
+            except (TypeError, ValueError, UnsupportedAlgorithm):
+                pass
 
     @classmethod
     def _get_encryption_key(cls) -> bytes:
@@ -41,23 +84,55 @@ class BaseEncryptedPersister(ABC):
         else:
             return cls.encryption_key
 
+    @classmethod
+    def _get_cipher(cls) -> AeadCipher:
+        """Return the cipher for the current encryption key, building it only when the key or the algorithm change."""
+        key = cls._get_encryption_key()
+        if cls._cipher is None or cls._cipher[0] != key or cls._cipher[1] is not cls.cipher_class:
+            cls._cipher = (key, cls.cipher_class, cls.cipher_class(key))
+        return cls._cipher[2]
+
+    @classmethod
+    def _decrypt(cls, encrypted_cassette: memoryview) -> bytes:
+        """Decrypt (and decompress, if needed) the content of an encrypted cassette file."""
+        # decrypt the cassette with the chosen aead algorithm
+        cipher = cls._get_cipher()
+        if encrypted_cassette[:len(_header_magic)] == _header_magic:
+            header, body = bytes(encrypted_cassette[:_header_length]), encrypted_cassette[_header_length:]
+            nonce, tagged_ciphertext = body[:12], body[12:]
+            try:
+                # the header was used as Authenticated Associated Data (aad)
+                cassette_content = cipher.decrypt(nonce, tagged_ciphertext, header)
+            except InvalidTag:
+                # this could still be a headerless cassette whose random nonce starts like the magic string
+                pass
+            else:
+                if header[-1] & ~_compressed_flag:
+                    raise ValueError("unsupported cassette format, try upgrading vcrpy-encrypt")
+                if header[-1] & _compressed_flag:
+                    cassette_content = zlib.decompress(cassette_content)
+                return cassette_content
+        # the first 12 bytes are the nonce, the rest is the bundled ciphertext and tag;
+        # no Authenticated Associated Data (aad) was used, hence None
+        return cipher.decrypt(encrypted_cassette[:12], encrypted_cassette[12:], None)
+
     @classmethod
     def load_cassette(cls, cassette_path, serializer):
         try:
             with open(f"{cassette_path}{cls.encoded_suffix}", "rb") as f:
-                nonce, tagged_ciphertext = [f.read(x) for x in (12, -1)]
+                encrypted_cassette = memoryview(f.read())
         except OSError:
             raise CassetteNotFoundError(f"Cassette not found at {cassette_path}")
         try:
-            # decrypt the cassette with aes-gcm
-            cipher = AESGCM(cls._get_encryption_key())
-            # no Authenticated Associated Data (aad) was used, hence None
-            cassette_content = cipher.decrypt(nonce, tagged_ciphertext, None)
-            # Check if clear text version is needed
-            clear_text_cassette = f"{cassette_path}{cls.clear_text_suffix}"
-            if cls.should_output_clear_text_as_well and not os.path.isfile(clear_text_cassette):
-                with open(clear_text_cassette, "wb") as f:
-                    f.write(cassette_content)
+            cassette_content = cls._decrypt(encrypted_cassette)
+            # Check if clear text version is needed: exclusive creation leaves an existing one untouched
+            # without having to stat it first
+            if cls.should_output_clear_text_as_well:
+                try:
+                    with open(f"{cassette_path}{cls.clear_text_suffix}", "xb") as f:
+                        f.write(cassette_content)
+                except FileExistsError:
+                    pass
             # Deserialize it
             cassette = deserialize(cassette_content, serializer)
         except (Exception,) as e:
@@ -66,21 +141,32 @@ class BaseEncryptedPersister(ABC):
 
     @classmethod
     def save_cassette(cls, cassette_path, cassette_dict, serializer):
-        data = serialize(cassette_dict, serializer)
+        # encode the serialized cassette once: the same bytes are both saved in clear text and encrypted
+        data = serialize(cassette_dict, serializer).encode("UTF-8")
         dirname, _ = os.path.split(cassette_path)
         if dirname and not os.path.exists(dirname):
-            os.makedirs(dirname)
+            os.makedirs(dirname, exist_ok=True)
         # save in clear text if specified
         if cls.should_output_clear_text_as_well:
-            with open(f"{cassette_path}{cls.clear_text_suffix}", "w") as f:
-                f.write(data)
-        # encrypt the cassette with aes-gcm
-        cipher = AESGCM(cls._get_encryption_key())
+            _write_atomically(f"{cassette_path}{cls.clear_text_suffix}", data)
+        # compress the cassette if specified, flagging it in the header
+        header = b""
+        if cls.should_compress:
+            header = _header_magic + bytes([_compressed_flag])
+            data = zlib.compress(data)
+        # encrypt the cassette with the chosen aead algorithm
+        cipher = cls._get_cipher()
         # make sure the nonce is unique every time
         nonce = os.urandom(12)
-        # no Authenticated Associated Data (aad) is needed; cryptography implementation
-        # will bundle the tag together with the ciphertext
-        tagged_ciphertext = cipher.encrypt(nonce, data.encode(), None)
-        # save to the file both the nonce and the bundled tag and ciphertext
-        with open(f"{cassette_path}{cls.encoded_suffix}", "wb") as f:
-            [f.write(x) for x in (nonce, tagged_ciphertext)]
+        # the header, if any, is used as Authenticated Associated Data (aad), so that it can't be tampered with;
+        # cryptography implementation will bundle the tag together with the ciphertext
+        tagged_ciphertext = cipher.encrypt(nonce, data, header or None)
+        # save to the file the header, the nonce and the bundled tag and ciphertext
+        _write_atomically(f"{cassette_path}{cls.encoded_suffix}", header + nonce + tagged_ciphertext)
+
+    @classmethod
+    def save_many(cls, cassettes: Iterable[Tuple[str, Any, Any]]):
+        """Save multiple cassettes, given as (cassette_path, cassette_dict, serializer) tuples, sharing the same cipher.
+        Handy when encrypting a batch of existing clear text cassettes."""
+        for cassette_path, cassette_dict, serializer in cassettes:
+            cls.save_cassette(cassette_path, cassette_dict, serializer)